@@ -5,10 +5,10 @@ import subprocess
 import cv2 as cv
 import sys
 import getopt
+import math
 from scipy.io.wavfile import read, write
-from tqdm import tqdm
+from numba import njit, prange
 from enum import Enum
-import decimal
 
 ####### GLOBAL DEFINITIONS, DO NOT EDIT! #######
 
@@ -29,6 +29,7 @@ GENERIC_EXCEPTION_STATUS = 103
 
 WINDOW_FACTOR = 5
 MARGIN = 100
+BLOCK_SIZE = 8192
 
 
 class CompressionAlgo(Enum):
@@ -69,6 +70,17 @@ def get_wav(name, ext):
             sys.exit(UNKNOWN_ERROR_STATUS)
 
 
+# Reads the file name.wav and returns its sample rate and its samples. The file is memory-mapped
+# when possible, so that computing the audio levels reads the samples from disk instead of from
+# a full copy in memory. scipy cannot memory-map some formats, such as 24-bit samples:
+# those files are read in memory.
+def read_wav(name):
+    try:
+        return read(f"{name}.wav", mmap=True)
+    except ValueError:
+        return read(f"{name}.wav")
+
+
 # Removes silence from a video file
 def cut_video(video_name, video_ext, output_name=None, method=ThresholdAlgo.MODERATE, compress=None):
     video = cv.VideoCapture(f"{video_name}{video_ext}")
@@ -77,71 +89,96 @@ def cut_video(video_name, video_ext, output_name=None, method=ThresholdAlgo.MODE
     get_wav(video_name, video_ext)
 
     if video.isOpened():
-        width = int(video.get(cv.CAP_PROP_FRAME_WIDTH))  # Frame width
-        height = int(video.get(cv.CAP_PROP_FRAME_HEIGHT))  # Frame height
         frame_count = int(video.get(cv.CAP_PROP_FRAME_COUNT))  # Number of frames in the video
+        video.release()
     else:
         print("Video streams closed unexpectedly. The program will be terminated.")
         return STREAM_CLOSED_UNEXPECTEDLY
 
-    samplerate, data = read(f"{video_name}.wav")
-    duration = decimal.Decimal(len(data)) / samplerate
+    samplerate, data = read_wav(video_name)
+    duration = len(data) / samplerate
     final_mask = get_edited_audio_matrix(data, samplerate, method)
+    # Final audio is a copy in memory of the samples to keep.
     final_audio = data[final_mask]
+    # Close the memory map, if any, so that the .wav file can be removed at the end.
+    del data
     # Duration of the video after the removal of silence
-    new_duration = decimal.Decimal(len(final_audio)) / samplerate
-    framerate = decimal.Decimal(frame_count) / duration  # Frame rate of the video
+    new_duration = len(final_audio) / samplerate
+    framerate = frame_count / duration  # Frame rate of the video
 
     # To keep contains the indexes of the audio samples from the original audio data array to keep
-    to_keep = np.where(final_mask == True)[0]
+    to_keep = np.flatnonzero(final_mask)
 
     if not output_name:
         output_name = f"{video_name}_sr.mp4"
 
-    temp_written_video = f"{video_name}_temp.mp4"
+    temp_written_filter = f"{video_name}_temp.txt"
     temp_written_audio = f"{video_name}_temp.wav"
 
-    fourcc = -1
-
-    if compress == CompressionAlgo.MID:
-        fourcc = cv.VideoWriter_fourcc(*'mp4v')
-
-    out = cv.VideoWriter(temp_written_video, fourcc, frame_count/float(duration), (width, height))
-    expected_frame = 0
+    # Number of audio samples per video frame
     increment = samplerate / framerate
+    # Number of frames of the output video
+    new_frame_count = math.ceil(new_duration * framerate)
+    # Index in 'to_keep' of the first audio sample of each group of 'increment' samples to keep
+    first_indexes = (np.arange(new_frame_count) * increment).astype(np.int64)
+    first_samples = to_keep[np.minimum(first_indexes, len(to_keep) - 1)]
+    # Index of the first audio sample of each frame of the original video, followed by the
+    # index of the audio sample after the end of the last frame.
+    frame_boundaries = np.arange(frame_count + 1) * increment
+    # Frame indexes contains the index of the frame of the original video that the first
+    # audio sample of each group points to. Since 'increment' is the audio length divided by
+    # the number of frames, the last boundary is the audio length: the clamp only guards
+    # against the rounding of the boundaries.
+    frame_indexes = np.searchsorted(frame_boundaries, first_samples, side='right') - 1
+    frame_indexes = np.minimum(frame_indexes, frame_count - 1)
+
+    # The select filter outputs each frame of the original video at most once, but when the number
+    # of samples per frame is not an integer, two consecutive groups may point to the same frame.
+    # The later group is then moved to the next frame, so that the video keeps one frame per group:
+    # within a section of kept audio, frames are shifted by at most one position.
+    positions = np.arange(new_frame_count)
+    frame_indexes = np.maximum.accumulate(frame_indexes - positions) + positions
+    # Groups moved after the last frame of the original video are filled with copies of it.
+    frame_indexes = frame_indexes[frame_indexes < frame_count]
+    missing_frames = new_frame_count - len(frame_indexes)
+
+    # Group the frames to keep in ranges of consecutive frames, and write a filter that selects
+    # those ranges from the original video and renumbers the timestamps of the selected frames.
+    breaks = np.flatnonzero(np.diff(frame_indexes) != 1) + 1
+    range_starts = frame_indexes[np.concatenate(([0], breaks))]
+    range_ends = frame_indexes[np.concatenate((breaks - 1, [len(frame_indexes) - 1]))]
+    select = "+".join(f"between(n,{start},{end})" for start, end in zip(range_starts, range_ends))
+    # The selected frames are timed and encoded at the same frame rate the frame table is built
+    # from, so that the cut video is as long as the cut audio.
+    video_filter = f"select='{select}',setpts=N/({framerate})/TB,fps={framerate}"
+    if missing_frames:
+        video_filter += f",tpad=stop_mode=clone:stop={missing_frames}"
+    with open(temp_written_filter, "w") as filter_file:
+        filter_file.write(video_filter)
+
+    # Write the final audio to disk.
+    write(temp_written_audio, samplerate, final_audio)
 
-    print("Processing video file...", flush=True)
-    if video.isOpened() and out.isOpened():
-        # Read the frames from the original video file and write on a new Stream
-        # the frames that the first audio sample of each group points to.
-        for index in tqdm(np.arange(0, len(to_keep), increment)):
-            while to_keep[int(index)] >= expected_frame:
-                _ = video.grab()
-                expected_frame += increment
-
-            _, frame = video.retrieve()
-            out.write(frame)
+    # Encoder options of the requested compression algorithm. The select filter requires the
+    # video to be re-encoded: the heavy compression keeps its libx264 CRF 20 encoding, while the
+    # lighter ones use a lower CRF and a faster preset, for larger files in less time.
+    if compress == CompressionAlgo.HEAVY:
+        video_codec = ['-c:v', 'libx264', '-crf', '20']
+    elif compress == CompressionAlgo.MID:
+        video_codec = ['-c:v', 'libx264', '-crf', '18', '-preset', 'veryfast']
     else:
-        print("Video streams closed unexpectedly. The program will be terminated.")
-        return STREAM_CLOSED_UNEXPECTEDLY
-
-    # Write the final audio to disk and close the read and write video streams.
-    write(temp_written_audio, samplerate, final_audio)
-    video.release()
-    out.release()
+        video_codec = ['-c:v', 'libx264', '-crf', '16', '-preset', 'ultrafast']
 
+    print("Processing video file...", flush=True)
     try:
-        # Check if compression is requested and, eventually, execute it.
-        if compress == CompressionAlgo.HEAVY:
-            cp_st = time.time()
-            subprocess.check_call(
-                ['ffmpeg', '-i', temp_written_video, '-i', temp_written_audio, '-c:v', 'libx264', "-crf", "20", output_name])
-
-            cp_et = time.time()
-            print(f"\nCompression completed in {cp_et - cp_st}s!")
-        else:
-            subprocess.check_call(
-                ['ffmpeg', '-i', temp_written_video, '-i', temp_written_audio, "-vcodec", "copy", output_name])
+        # Cut the video and merge it with the final audio in a single pass.
+        cp_st = time.time()
+        subprocess.check_call(
+            ['ffmpeg', '-i', f'{video_name}{video_ext}', '-i', temp_written_audio, '-filter_script:v',
+             temp_written_filter, '-map', '0:v:0', '-map', '1:a:0', *video_codec, output_name])
+
+        cp_et = time.time()
+        print(f"\nVideo processing completed in {cp_et - cp_st}s!")
 
     except subprocess.CalledProcessError:
         if os.path.exists(output_name):
@@ -153,58 +190,176 @@ def cut_video(video_name, video_ext, output_name=None, method=ThresholdAlgo.MODE
 
     # Remove the temporary files.
     try:
-        os.remove(temp_written_video)
+        os.remove(temp_written_filter)
         os.remove(temp_written_audio)
         os.remove(f"{video_name}.wav")
     except Exception as ex:
         print(ex)
 
 
+# Returns the level of each sample of 'data', a (samples, channels) matrix, computed in a
+# single pass as the sum of the absolute values of its channels.
+@njit(["float32[::1](int32[:, ::1])", "float32[::1](int64[:, ::1])", "float32[::1](float32[:, ::1])",
+       "float32[::1](float64[:, ::1])"],
+      parallel=True, fastmath=True, cache=True)
+def abs_sum(data):
+    n, channels = data.shape
+    levels = np.empty(n, np.float32)
+    # Each thread processes blocks of 'BLOCK_SIZE' contiguous samples, small enough for the
+    # input and output of a block to stay in cache.
+    for block in prange((n + BLOCK_SIZE - 1) // BLOCK_SIZE):
+        for i in range(block * BLOCK_SIZE, min(n, (block + 1) * BLOCK_SIZE)):
+            level = np.float32(0)
+            for c in range(channels):
+                level += abs(np.float32(data[i, c]))
+            levels[i] = level
+
+    return levels
+
+
+# Same as 'abs_sum', for integer samples of up to 16 bits: the levels are computed with
+# integer arithmetic and written in the unsigned integer array 'levels'. The absolute
+# values are clamped to 32767, so that the level of a stereo sample fits in 16 bits.
+@njit(["void(int16[:, ::1], uint16[::1])", "void(int16[:, ::1], uint32[::1])",
+       "void(uint8[:, ::1], uint16[::1])", "void(uint8[:, ::1], uint32[::1])"],
+      parallel=True, cache=True)
+def pcm_abs_sum(data, levels):
+    n, channels = data.shape
+    for block in prange((n + BLOCK_SIZE - 1) // BLOCK_SIZE):
+        for i in range(block * BLOCK_SIZE, min(n, (block + 1) * BLOCK_SIZE)):
+            level = np.int32(0)
+            for c in range(channels):
+                level += min(abs(np.int32(data[i, c])), 32767)
+            levels[i] = level
+
+
+# Returns the histogram of the integer audio levels 'data_tmp', with 'bins' bins.
+@njit(["int64[::1](uint16[::1], int64)", "int64[::1](uint32[::1], int64)"], cache=True)
+def level_histogram(data_tmp, bins):
+    hist = np.zeros(bins, np.int64)
+    for i in range(data_tmp.size):
+        hist[data_tmp[i]] += 1
+
+    return hist
+
+
+# Scans the audio levels 'data_tmp' once and returns the bounds (starts, ends) of the silent
+# intervals: the gaps between samples louder than 'threshold' that are longer than 'consec'
+# samples, without their first and last 'margin' samples.
+@njit(["UniTuple(int64[:], 2)(uint16[::1], int64, int64, int64)",
+       "UniTuple(int64[:], 2)(uint32[::1], int64, int64, int64)",
+       "UniTuple(int64[:], 2)(float32[::1], float64, int64, int64)"], cache=True)
+def find_silent_intervals(data_tmp, threshold, consec, margin):
+    # Each interval is preceded by more than 'consec' silent samples.
+    max_intervals = data_tmp.size // (consec + 1) + 1
+    starts = np.empty(max_intervals, np.int64)
+    ends = np.empty(max_intervals, np.int64)
+    count = 0
+    last_loud = 0
+    for i in range(data_tmp.size):
+        if data_tmp[i] >= threshold:
+            # If the number of consecutive silenced frames is greater than 'consec'...
+            if i - last_loud > consec:
+                # Do not keep those samples, except for the first 'margin' and last 'margin', to make
+                # the transition from silence to sound less rough.
+                start = last_loud + margin
+                end = i - margin
+                if end > start:
+                    starts[count] = start
+                    ends[count] = end
+                    count += 1
+
+            # Update the last loud index
+            last_loud = i
+
+    return starts[:count], ends[:count]
+
+
+# Returns a mask of 'n' bits, packed 8 per byte in the order used by np.unpackbits, that is
+# 0 inside the intervals [starts, ends) and 1 elsewhere.
+@njit("uint8[:](int64[:], int64[:], int64)", parallel=True, cache=True)
+def _build_mask(starts, ends, n):
+    out = np.full((n + 7) // 8, 0xFF, np.uint8)
+    # The whole bytes of the intervals are disjoint, so they are cleared in parallel.
+    for k in prange(starts.size):
+        out[(starts[k] + 7) >> 3:ends[k] >> 3] = 0
+
+    # Two intervals may share a partial byte at their bounds, so those are updated sequentially.
+    for k in range(starts.size):
+        start = starts[k]
+        end = ends[k]
+        first_byte = start >> 3
+        last_byte = end >> 3
+        # The bits of sample offsets [start % 8, 8) and [0, end % 8) in the first and last byte.
+        head_bits = 0xFF >> (start & 7)
+        tail_bits = 0xFF ^ (0xFF >> (end & 7))
+        if first_byte == last_byte:
+            out[first_byte] &= 0xFF ^ (head_bits & tail_bits)
+        else:
+            if start & 7:
+                out[first_byte] &= 0xFF ^ head_bits
+            if tail_bits:
+                out[last_byte] &= 0xFF ^ tail_bits
+
+    return out
+
+
 # Returns an array of booleans 'final_mask' that indicates which audio samples
 # from the original audio file to keep (True) or to discard (False).
 def get_edited_audio_matrix(data, samplerate, method=ThresholdAlgo.MODERATE):
-    channels = len(data.shape)
-    # If there are two channels, the mean of the values of the
-    # two channels are used to calculate the silence threshold.
-    if channels == 2:
-        data_tmp = np.mean(np.abs(data), axis=1)
+    # The level of each sample, used to calculate the silence threshold, is the sum of the
+    # absolute values of its channels.
+    # The kernels take C-contiguous arrays: scipy already returns one, so it is not copied.
+    data = np.ascontiguousarray(data[:, None] if data.ndim == 1 else data)
+    channels = data.shape[1]
+    pcm = np.issubdtype(data.dtype, np.integer) and data.dtype.itemsize <= 2
+
+    # Mean of the audio levels and mean of the levels below it.
+    if pcm:
+        # Integer samples of up to 16 bits only have a few thousands distinct levels, so both
+        # means are calculated exactly from a histogram built in a single pass.
+        info = np.iinfo(data.dtype)
+        max_level = channels * min(max(-info.min, info.max), 32767)
+        data_tmp = np.empty(len(data), np.uint16 if max_level <= np.iinfo(np.uint16).max else np.uint32)
+        pcm_abs_sum(data, data_tmp)
+        hist = level_histogram(data_tmp, max_level + 1)
+        counts = np.cumsum(hist)
+        weights = np.cumsum(hist * np.arange(max_level + 1))
+        # An empty audio track has no levels: its mean is taken as 0.
+        level_mean = weights[-1] / counts[-1] if counts[-1] else 0
+        # Number of levels strictly below the mean
+        below = int(np.ceil(level_mean))
+        below_count = counts[below - 1] if below else 0
+        # If no level is below the mean, the threshold will keep every sample.
+        low_level_mean = weights[below - 1] / below_count if below_count else 0
     else:
-        data_tmp = np.abs(data)
+        data_tmp = abs_sum(data)
+        level_mean = np.mean(data_tmp, dtype=np.float64)
+        low_level_mean = None
+        if method in (ThresholdAlgo.SENSITIVE, ThresholdAlgo.MODERATE):
+            low_level_mean = np.mean(data_tmp[data_tmp < level_mean], dtype=np.float64)
 
     if method == ThresholdAlgo.SENSITIVE:
-        first_threshold = np.mean(data_tmp)
-        mask1 = np.abs(data_tmp) < first_threshold
-        data_mask = data_tmp[mask1]
-        silence_threshold = (np.mean(data_mask)) * 2
+        silence_threshold = low_level_mean * 2
     elif method == ThresholdAlgo.WEAK:
-        silence_threshold = np.mean(data_tmp) / 2
+        silence_threshold = level_mean / 2
     elif method == ThresholdAlgo.MODERATE:
-        first_threshold = np.mean(data_tmp)
-        mask1 = np.abs(data_tmp) < first_threshold
-        data_mask = data_tmp[mask1]
-        silence_threshold = (np.mean(data_mask)+first_threshold) / 2
+        silence_threshold = (low_level_mean + level_mean) / 2
     elif method == ThresholdAlgo.STRONG:
-        silence_threshold = np.mean(data_tmp)
+        silence_threshold = level_mean
+
+    if pcm:
+        # The levels are integers, so they can be compared with an integer threshold.
+        silence_threshold = int(np.ceil(silence_threshold))
 
     # The number of consecutive frames of value less than the silence threshold needed
     # for that section of the audio to be considered "silent".
     consec_frames = samplerate // WINDOW_FACTOR
-    mask = np.abs(data_tmp) < silence_threshold
 
-    # To check contains the indexes of the audio samples from the original audio data array to keep
-    to_check = np.where(mask == False)[0]
-    final_mask = np.ones(mask.shape, dtype=bool)
-    last_ind = 0
     print("Cutting audio file...", flush=True)
-    for ind in tqdm(to_check):
-        # If the number of consecutive silenced frames is greater than 'consec_frames'...
-        if ind - last_ind > consec_frames:
-            # Do not keep those samples, except for the first 'MARGIN' and last 'MARGIN', to make
-            # the transition from silence to sound less rough.
-            final_mask[last_ind + MARGIN:ind - MARGIN] = False
-
-        # Update the last index
-        last_ind = ind
+    starts, ends = find_silent_intervals(data_tmp, silence_threshold, consec_frames, MARGIN)
+    packed_mask = _build_mask(starts, ends, len(data_tmp))
+    final_mask = np.unpackbits(packed_mask, count=len(data_tmp)).view(bool)
 
     return final_mask
 
@@ -216,7 +371,7 @@ def cut_audio(audio_name, audio_ext, output_name=None, method=ThresholdAlgo.MODE
         get_wav(audio_name, audio_ext)
 
     # Gets the sample rate of the audio file and an array containing the audio samples.
-    samplerate, data = read(f"{audio_name}.wav")
+    samplerate, data = read_wav(audio_name)
     final_mask = get_edited_audio_matrix(data, samplerate, method=ThresholdAlgo.MODERATE)
 
     if not output_name:
@@ -228,6 +383,9 @@ def cut_audio(audio_name, audio_ext, output_name=None, method=ThresholdAlgo.MODE
         print(ex)
         sys.exit(GENERIC_EXCEPTION_STATUS)
 
+    # Close the memory map, if any, so that the .wav file can be removed.
+    del data
+
     if audio_ext != ".wav":
         try:
             os.remove(f"{audio_name}.wav")